@@ -108,7 +108,8 @@ def sample_batch(scramble_buffer, net, device, batch_size, value_targets):
     shape = explored_states.shape
     explored_states_t = torch.tensor(explored_states).to(device)
     explored_states_t = explored_states_t.view(shape[0]*shape[1], *shape[2:])     # shape: (states*actions, encoded_shape)
-    value_t = net(explored_states_t, value_only=True)
+    with torch.no_grad():
+        value_t = net(explored_states_t, value_only=True)
     value_t = value_t.squeeze(-1).view(shape[0], shape[1])                  # shape: (states, actions)
     if value_targets == ValueTargetsMethod.Paper:
         # add reward to the values
@@ -120,9 +121,9 @@ def sample_batch(scramble_buffer, net, device, batch_size, value_targets):
     elif value_targets == ValueTargetsMethod.ZeroGoalValue:
         value_t -= 1.0
         max_val_t, max_act_t = value_t.max(dim=1)
-        goal_indices = np.nonzero(is_goals)
-        max_val_t[goal_indices] = 0.0
-        max_act_t[goal_indices] = 0
+        goals_t = torch.tensor(is_goals, dtype=torch.bool).to(device)
+        max_val_t.masked_fill_(goals_t, 0.0)
+        max_act_t.masked_fill_(goals_t, 0)
     else:
         assert False, "Unsupported method of value targets"
 
@@ -150,13 +151,12 @@ def make_train_data(cube_env, net, device, batch_size, scramble_depth, shuffle=F
 
     # explore each state by doing 1-step BFS search and keep a mask of goal states (for reward calculation)
     explored_states, explored_goals = [], []
-    goal_indices = []
-    for idx, s in enumerate(cube_states):
+    is_goals = []
+    for s in cube_states:
         states, goals = cube_env.explore_state(s)
         explored_states.append(states)
         explored_goals.append(goals)
-        if cube_env.is_goal(s):
-            goal_indices.append(idx)
+        is_goals.append(cube_env.is_goal(s))
 
     # obtain network's values for all explored states
     enc_explored = encode_states(cube_env, explored_states)           # shape: (states, actions, encoded_shape)
@@ -164,7 +164,8 @@ def make_train_data(cube_env, net, device, batch_size, scramble_depth, shuffle=F
     shape = enc_explored.shape
     enc_explored_t = torch.tensor(enc_explored).to(device)
     enc_explored_t = enc_explored_t.view(shape[0]*shape[1], *shape[2:])     # shape: (states*actions, encoded_shape)
-    value_t = net(enc_explored_t, value_only=True)
+    with torch.no_grad():
+        value_t = net(enc_explored_t, value_only=True)
     value_t = value_t.squeeze(-1).view(shape[0], shape[1])                  # shape: (states, actions)
     if value_targets == ValueTargetsMethod.Paper:
         # add reward to the values
@@ -176,8 +177,9 @@ def make_train_data(cube_env, net, device, batch_size, scramble_depth, shuffle=F
     elif value_targets == ValueTargetsMethod.ZeroGoalValue:
         value_t -= 1.0
         max_val_t, max_act_t = value_t.max(dim=1)
-        max_val_t[goal_indices] = 0.0
-        max_act_t[goal_indices] = 0
+        goals_t = torch.tensor(is_goals, dtype=torch.bool).to(device)
+        max_val_t.masked_fill_(goals_t, 0.0)
+        max_act_t.masked_fill_(goals_t, 0)
     else:
         assert False, "Unsupported method of value targets"
 
@@ -3,7 +3,6 @@ import os
 import time
 import argparse
 import logging
-import numpy as np
 import collections
 
 import torch
@@ -44,7 +43,7 @@ if __name__ == "__main__":
     net = model.Net(cube_env.encoded_shape, len(cube_env.action_enum)).to(device)
     net_target = model.Net(cube_env.encoded_shape, len(cube_env.action_enum)).to(device)
     print(net) 
-    opt = optim.Adam(net.parameters(), lr=config.train_learning_rate)
+    opt = optim.Adam(net.parameters(), lr=config.train_learning_rate, fused=config.train_cuda)
     sched = scheduler.StepLR(opt, 1, gamma=config.train_lr_decay_gamma) if config.train_lr_decay_enabled else None
 
     step_idx = 0
@@ -72,7 +71,7 @@ if __name__ == "__main__":
             scramble_buf, net_target, device, config.train_batch_size, value_targets_method)
 
         # replay buffer: (s_cur, a, r, s_nxt)
-        opt.zero_grad()
+        opt.zero_grad(set_to_none=True)
         policy_out_t, value_out_t = net(x_t)
         value_out_t = value_out_t.squeeze(-1)
         value_loss_t = (value_out_t - y_value_t)**2
@@ -90,34 +89,34 @@ if __name__ == "__main__":
         loss_t.backward()
         opt.step()
 
-        # save data
-        buf_mean_values.append(value_out_t.mean().item())
-        buf_policy_loss.append(policy_loss_t.item())
-        buf_value_loss.append(value_loss_t.item())
-        buf_loss.append(loss_t.item())
-        buf_loss_raw.append(loss_raw_t.item())
-        buf_value_loss_raw.append(value_loss_raw_t.item())
-        buf_policy_loss_raw.append(policy_loss_raw_t.item())
+        # save data, values are kept on the device to avoid sync on every batch
+        buf_mean_values.append(value_out_t.detach().mean())
+        buf_policy_loss.append(policy_loss_t.detach())
+        buf_value_loss.append(value_loss_t.detach())
+        buf_loss.append(loss_t.detach())
+        buf_loss_raw.append(loss_raw_t.detach())
+        buf_value_loss_raw.append(value_loss_raw_t.detach())
+        buf_policy_loss_raw.append(policy_loss_raw_t.detach())
 
         if step_idx % args.update == 0:
             net_target.load_state_dict(net.state_dict())
 
         if config.train_report_batches is not None and step_idx % config.train_report_batches == 0:
-            m_policy_loss = np.mean(buf_policy_loss)
-            m_value_loss = np.mean(buf_value_loss)
-            m_loss = np.mean(buf_loss)
+            m_policy_loss = torch.stack(buf_policy_loss).mean().item()
+            m_value_loss = torch.stack(buf_value_loss).mean().item()
+            m_loss = torch.stack(buf_loss).mean().item()
             buf_value_loss.clear()
             buf_policy_loss.clear()
             buf_loss.clear()
 
-            m_policy_loss_raw = np.mean(buf_policy_loss_raw)
-            m_value_loss_raw = np.mean(buf_value_loss_raw)
-            m_loss_raw = np.mean(buf_loss_raw)
+            m_policy_loss_raw = torch.stack(buf_policy_loss_raw).mean().item()
+            m_value_loss_raw = torch.stack(buf_value_loss_raw).mean().item()
+            m_loss_raw = torch.stack(buf_loss_raw).mean().item()
             buf_value_loss_raw.clear()
             buf_policy_loss_raw.clear()
             buf_loss_raw.clear()
 
-            m_values = np.mean(buf_mean_values)
+            m_values = torch.stack(buf_mean_values).mean().item()
             buf_mean_values.clear()
 
             dt = time.time() - ts
@@ -1,9 +1,12 @@
 import sys
 import time
+import queue
+import threading
+import collections
+import multiprocessing as mp
 import numpy as np
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
 
 
 HYPERPARAMS = {
@@ -52,46 +55,389 @@ HYPERPARAMS = {
 }
 
 
-def unpack_batch(batch):
-    states, actions, rewards, dones, last_states = [], [], [], [], []
-    for exp in batch:
+def states_preprocessor(states):
+    """
+    Convert list of agent's states into uint8 tensor. Frames are scaled to float by the model on the device,
+    so transfer stays four times smaller than for float32
+    """
+    return torch.from_numpy(np.array([np.array(s, copy=False) for s in states], dtype=np.uint8))
+
+
+class ThreadedExperienceSource:
+    """
+    Wrapper which plays experience source in background thread, so env stepping overlaps with training
+    in the main thread. Experience is passed through bounded queue, which pauses the thread when consumer
+    falls behind. Provides the same interface as wrapped source: iteration and pop_total_rewards().
+    Exception raised by the wrapped source is re-raised in the consumer's thread.
+    """
+    def __init__(self, exp_source, queue_size=1000):
+        self.exp_source = exp_source
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.total_rewards = []
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            for exp in self.exp_source:
+                rewards = self.exp_source.pop_total_rewards()
+                if rewards:
+                    with self.lock:
+                        self.total_rewards.extend(rewards)
+                self.queue.put(exp)
+        except Exception as e:
+            # pass the error to the consumer, otherwise it will wait for the next entry forever
+            self.queue.put(e)
+            return
+        self.queue.put(StopIteration())
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if isinstance(item, StopIteration):
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def pop_total_rewards(self):
+        with self.lock:
+            r = self.total_rewards
+            self.total_rewards = []
+        return r
+
+
+# the same fields as ptan's ExperienceFirstLast, so replay buffers and batch functions accept both
+ExperienceFirstLast = collections.namedtuple('ExperienceFirstLast', field_names=['state', 'action', 'reward',
+                                                                                 'last_state'])
+
+
+def _env_worker(env_factory, conn):
+    """
+    Plays environment for ProcessExperienceSource: sends initial observation, then for every received action
+    sends back tuple of next observation, reward and done flag. Finished episode is reset in place, so
+    observation sent with done flag is the first one of the new episode.
+    """
+    env = env_factory()
+    conn.send(env.reset())
+    while True:
+        action = conn.recv()
+        if action is None:
+            break
+        obs, reward, is_done, _ = env.step(action)
+        if is_done:
+            obs = env.reset()
+        conn.send((obs, reward, is_done))
+    conn.close()
+
+
+class ProcessExperienceSource:
+    """
+    First-last n-step experience source, which plays environments in worker processes. On every step
+    actions for all environments are chosen by one agent call, then all workers step their environments
+    in parallel, so env latency doesn't grow with count of environments. Yields ExperienceFirstLast entries
+    and provides pop_total_rewards() like ptan's ExperienceSourceFirstLast.
+    :param env_factory: picklable callable creating the environment, called in every worker
+    """
+    def __init__(self, env_factory, env_count, agent, gamma, steps_count=1):
+        self.agent = agent
+        self.gamma = gamma
+        self.steps_count = steps_count
+        self.total_rewards = []
+        self.conns = []
+        self.workers = []
+        for _ in range(env_count):
+            conn, worker_conn = mp.Pipe()
+            worker = mp.Process(target=_env_worker, args=(env_factory, worker_conn), daemon=True)
+            worker.start()
+            worker_conn.close()
+            self.conns.append(conn)
+            self.workers.append(worker)
+
+    def _first_last(self, history, last_state):
+        reward = 0.0
+        for _, _, r in reversed(history):
+            reward = r + self.gamma * reward
+        state, action, _ = history[0]
+        return ExperienceFirstLast(state=state, action=action, reward=reward, last_state=last_state)
+
+    def __iter__(self):
+        states = [conn.recv() for conn in self.conns]
+        histories = [collections.deque(maxlen=self.steps_count) for _ in self.conns]
+        cur_rewards = [0.0] * len(self.conns)
+        agent_states = [None] * len(self.conns)
+        while True:
+            actions, agent_states = self.agent(states, agent_states)
+            for conn, action in zip(self.conns, actions):
+                conn.send(action)
+            for idx, conn in enumerate(self.conns):
+                obs, reward, is_done = conn.recv()
+                history = histories[idx]
+                history.append((states[idx], actions[idx], reward))
+                cur_rewards[idx] += reward
+                states[idx] = obs
+                if not is_done:
+                    if len(history) == self.steps_count:
+                        yield self._first_last(history, obs)
+                    continue
+                self.total_rewards.append(cur_rewards[idx])
+                cur_rewards[idx] = 0.0
+                # episode is over, all entries left in the history end with terminal state
+                while history:
+                    yield self._first_last(history, None)
+                    history.popleft()
+
+    def pop_total_rewards(self):
+        r = self.total_rewards
+        if r:
+            self.total_rewards = []
+        return r
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(None)
+        for worker in self.workers:
+            worker.join()
+
+
+class StatesBuffer:
+    """
+    Preallocated buffers to pass states of the batch to the device. States are written into pinned
+    host memory and copied asynchronously, so transfer overlaps with work already queued on GPU.
+    Stacked frames of the state and of the last state steps_count steps later are shared except the
+    first steps_count frames, so every entry holds state's frames followed only by new frames of the
+    last state, and both states are returned as views of it.
+    """
+    def __init__(self, batch_size, state_shape, steps_count=1, cuda=False):
+        self.cuda = cuda
+        self.frames = state_shape[0]
+        self.shift = min(steps_count, self.frames)
+        shape = (batch_size, self.frames + self.shift) + tuple(state_shape[1:])
+        self.host = torch.empty(shape, dtype=torch.uint8, pin_memory=cuda)
+        self.host_np = self.host.numpy()
+        if cuda:
+            self.device = torch.empty_like(self.host, device='cuda')
+            self.copied = torch.cuda.Event()
+            self.copied.record()
+        else:
+            self.device = self.host
+        self.layout_checked = False
+
+    def check_layout(self, state, last_state):
+        """
+        Check that state and last state share frames as the layout expects. It is enough to do it once
+        on the first non-terminal experience, as it depends only on frames stacking and steps_count
+        """
+        shared = self.frames - self.shift
+        assert np.array_equal(last_state[:shared], state[self.shift:]), \
+            "Last state doesn't share %d frames with state, check frames stacking and steps_count" % shared
+        self.layout_checked = True
+
+    def host_array(self):
+        """
+        Return host buffer to be filled, waiting for the previous copy to finish
+        """
+        if self.cuda:
+            self.copied.synchronize()
+        return self.host_np
+
+    def transfer(self):
+        """
+        Start copy of the host buffer to the device
+        :return: entries tensor with state and last state frames, view of the device buffer
+        """
+        if self.cuda:
+            self.device.copy_(self.host, non_blocking=True)
+            self.copied.record()
+        return self.device
+
+    def split(self, entries):
+        """
+        Split entries into states and last states
+        :return: tuple of states and last states tensors, views of entries
+        """
+        return entries[:, :self.frames], entries[:, self.shift:self.shift + self.frames]
+
+
+def unpack_batch(batch, states_buf):
+    entries = states_buf.host_array()
+    frames = states_buf.frames
+    actions, rewards, dones = [], [], []
+    for idx, exp in enumerate(batch):
         state = np.array(exp.state, copy=False)
-        states.append(state)
+        entries[idx, :frames] = state
         actions.append(exp.action)
         rewards.append(exp.reward)
         dones.append(exp.last_state is None)
         if exp.last_state is None:
-            last_states.append(state)       # the result will be masked anyway
+            entries[idx, frames:] = state[frames - states_buf.shift:]      # the result will be masked anyway
         else:
-            last_states.append(np.array(exp.last_state, copy=False))
-    return np.array(states, copy=False), np.array(actions), np.array(rewards, dtype=np.float32), \
-           np.array(dones, dtype=np.uint8), np.array(last_states, copy=False)
+            last_state = np.array(exp.last_state, copy=False)
+            if not states_buf.layout_checked:
+                states_buf.check_layout(state, last_state)
+            entries[idx, frames:] = last_state[frames - states_buf.shift:]
+    return np.array(actions), np.array(rewards, dtype=np.float32), np.array(dones, dtype=bool)
 
 
-def calc_loss_dqn(batch, net, tgt_net, gamma, cuda=False):
-    states, actions, rewards, dones, next_states = unpack_batch(batch)
+def batch_to_tensors(batch, states_buf, cuda=False):
+    """
+    Convert batch of experiences into tensors
+    :return: tuple of states, actions, rewards, done mask and next states tensors
+    """
+    actions, rewards, dones = unpack_batch(batch, states_buf)
 
-    states_v = Variable(torch.from_numpy(states))
-    next_states_v = Variable(torch.from_numpy(next_states), volatile=True)
-    actions_v = Variable(torch.from_numpy(actions))
-    rewards_v = Variable(torch.from_numpy(rewards))
-    done_mask = torch.ByteTensor(dones)
+    states_v, next_states_v = states_buf.split(states_buf.transfer())
+    actions_v = torch.from_numpy(actions)
+    rewards_v = torch.from_numpy(rewards)
+    done_mask = torch.from_numpy(dones)
     if cuda:
-        states_v = states_v.cuda()
-        next_states_v = next_states_v.cuda()
         actions_v = actions_v.cuda()
         rewards_v = rewards_v.cuda()
         done_mask = done_mask.cuda()
+    return states_v, actions_v, rewards_v, done_mask, next_states_v
 
-    state_action_values = net(states_v).gather(1, actions_v.unsqueeze(-1)).squeeze(-1)
-    next_state_values = tgt_net(next_states_v).max(1)[0]
-    next_state_values[done_mask] = 0.0
-    next_state_values.volatile = False
 
-    expected_state_action_values = next_state_values * gamma + rewards_v
+def calc_loss_dqn(batch, states_buf, net, tgt_net, gamma, cuda=False):
+    return calc_loss_dqn_v(*batch_to_tensors(batch, states_buf, cuda=cuda), net, tgt_net, gamma)
+
+
+def calc_loss_dqn_v(states_v, actions_v, rewards_v, done_mask, next_states_v, net, tgt_net, gamma):
+    """
+    Same as calc_loss_dqn, but for batch already placed in tensors
+    """
+    state_action_values = net(states_v).gather(1, actions_v.unsqueeze(-1)).squeeze(-1)
+    with torch.no_grad():
+        next_state_values = tgt_net(next_states_v).max(1)[0]
+        expected_state_action_values = rewards_v + gamma * next_state_values.masked_fill(done_mask, 0.0)
     return nn.MSELoss()(state_action_values, expected_state_action_values)
 
 
+class GraphedTrainStep:
+    """
+    DQN train step (forward, backward and optimizer step) captured into CUDA graph and replayed on static
+    input tensors, which removes per-kernel launch overhead of the small net. First warmup_steps calls are
+    done eagerly on a side stream, as capture requires. Optimizer has to be created with capturable=True.
+    """
+    def __init__(self, net, tgt_net, optimizer, gamma, batch_size, state_shape, warmup_steps=3):
+        self.net = net
+        self.tgt_net = tgt_net
+        self.optimizer = optimizer
+        self.gamma = gamma
+        self.warmup_steps = warmup_steps
+        shape = (batch_size, ) + tuple(state_shape)
+        self.inputs = (
+            torch.zeros(shape, dtype=torch.uint8, device="cuda"),
+            torch.zeros(batch_size, dtype=torch.int64, device="cuda"),
+            torch.zeros(batch_size, dtype=torch.float32, device="cuda"),
+            torch.zeros(batch_size, dtype=torch.bool, device="cuda"),
+            torch.zeros(shape, dtype=torch.uint8, device="cuda"),
+        )
+        self.graph = None
+        self.loss_v = None
+
+    def _step(self):
+        self.optimizer.zero_grad(set_to_none=True)
+        self.loss_v = calc_loss_dqn_v(*self.inputs, self.net, self.tgt_net, self.gamma)
+        self.loss_v.backward()
+        self.optimizer.step()
+
+    def step(self, *batch):
+        """
+        Perform train step on the batch
+        :param batch: tuple of states, actions, rewards, done mask and next states tensors
+        :return: loss tensor, overwritten by the next step
+        """
+        for static_v, batch_v in zip(self.inputs, batch):
+            static_v.copy_(batch_v, non_blocking=True)
+        if self.graph is not None:
+            self.graph.replay()
+        elif self.warmup_steps > 0:
+            self.warmup_steps -= 1
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                self._step()
+            torch.cuda.current_stream().wait_stream(stream)
+        else:
+            self.graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self.graph):
+                self._step()
+            self.graph.replay()
+        return self.loss_v
+
+
+class DeviceReplayBuffer:
+    """
+    Replay buffer which keeps experience in device memory. New experience is collected on the host and pushed
+    to the device in chunks of update_size entries through preallocated pinned buffer, sampling is done by
+    indexing on the device, so sampled batches never cross PCIe. Experience becomes available for sampling
+    only after its chunk was pushed. States are stored in StatesBuffer layout, without frames shared by
+    state and last state.
+    """
+    def __init__(self, experience_source, buffer_size, state_shape, steps_count=1, update_size=2000,
+                 device="cuda"):
+        self.experience_source_iter = iter(experience_source)
+        self.capacity = buffer_size
+        self.update_size = min(update_size, buffer_size)
+        self.device = device
+        # chunks are passed through fixed pinned buffer, allocated once
+        self.staging = StatesBuffer(self.update_size, state_shape, steps_count=steps_count,
+                                    cuda=torch.device(device).type == "cuda")
+        shape = (buffer_size, ) + tuple(self.staging.host.size()[1:])
+        self.entries = torch.empty(shape, dtype=torch.uint8, device=device)
+        self.actions = torch.empty(buffer_size, dtype=torch.int64, device=device)
+        self.rewards = torch.empty(buffer_size, dtype=torch.float32, device=device)
+        self.dones = torch.empty(buffer_size, dtype=torch.bool, device=device)
+        self.pos = 0
+        self.size = 0
+        self.pending = []
+
+    @staticmethod
+    def memory_size(buffer_size, state_shape, steps_count=1):
+        """
+        Count of device memory bytes taken by the buffer of given size
+        """
+        frames = state_shape[0]
+        entry_size = (frames + min(steps_count, frames)) * int(np.prod(state_shape[1:]))
+        # uint8 states, int64 action, float32 reward and bool done flag
+        return buffer_size * (entry_size + 8 + 4 + 1)
+
+    def __len__(self):
+        return self.size
+
+    def populate(self, samples):
+        """
+        Populates samples into the buffer
+        :param samples: how many samples to populate
+        """
+        for _ in range(samples):
+            self.pending.append(next(self.experience_source_iter))
+            if len(self.pending) == self.update_size:
+                self._push()
+
+    def _push(self):
+        actions, rewards, dones = unpack_batch(self.pending, self.staging)
+        idx = (torch.arange(self.update_size) + self.pos) % self.capacity
+        idx = idx.to(self.device)
+        self.entries.index_copy_(0, idx, self.staging.transfer())
+        self.actions.index_copy_(0, idx, torch.from_numpy(actions).to(self.device))
+        self.rewards.index_copy_(0, idx, torch.from_numpy(rewards).to(self.device))
+        self.dones.index_copy_(0, idx, torch.from_numpy(dones).to(self.device))
+        self.pos = (self.pos + self.update_size) % self.capacity
+        self.size = min(self.size + self.update_size, self.capacity)
+        self.pending.clear()
+
+    def sample(self, batch_size):
+        """
+        Get random batch from the buffer
+        :return: tuple of states, actions, rewards, done mask and next states tensors
+        """
+        idx = torch.randint(self.size, (batch_size, ), device=self.device)
+        states_v, next_states_v = self.staging.split(self.entries.index_select(0, idx))
+        return states_v, self.actions[idx], self.rewards[idx], self.dones[idx], next_states_v
+
+
 class RewardTracker:
     def __init__(self, writer, stop_reward):
         self.writer = writer
@@ -2,7 +2,6 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
 
 import numpy as np
 
@@ -19,16 +18,16 @@ class NoisyLinear(nn.Linear):
 
     def reset_parameters(self):
         std = math.sqrt(3 / self.in_features)
-        nn.init.uniform(self.weight, -std, std)
-        nn.init.uniform(self.bias, -std, std)
+        nn.init.uniform_(self.weight, -std, std)
+        nn.init.uniform_(self.bias, -std, std)
 
     def forward(self, input):
         torch.randn(self.epsilon_weight.size(), out=self.epsilon_weight)
         bias = self.bias
         if bias is not None:
             torch.randn(self.epsilon_bias.size(), out=self.epsilon_bias)
-            bias = bias + self.sigma_bias * Variable(self.epsilon_bias)
-        return F.linear(input, self.weight + self.sigma_weight * Variable(self.epsilon_weight), bias)
+            bias = bias + self.sigma_bias * self.epsilon_bias
+        return F.linear(input, self.weight + self.sigma_weight * self.epsilon_weight, bias)
 
 
 class NoisyFactorizedLinear(nn.Linear):
@@ -56,8 +55,8 @@ class NoisyFactorizedLinear(nn.Linear):
 
         bias = self.bias
         if bias is not None:
-            bias = bias + self.sigma_bias * Variable(eps_out.t())
-        noise_v = Variable(torch.mul(eps_in, eps_out))
+            bias = bias + self.sigma_bias * eps_out.t()
+        noise_v = torch.mul(eps_in, eps_out)
         return F.linear(input, self.weight + self.sigma_weight * noise_v, bias)
 
 
@@ -67,16 +66,11 @@ class NoisyLinearExt(nn.Linear):
     """
     def __init__(self, in_features, out_features, bias=True):
         super(NoisyLinearExt, self).__init__(in_features, out_features, bias=bias)
-        self.rand_buf = None
 
     def forward(self, input, sigma=None):
         res = F.linear(input, self.weight, self.bias)
         if sigma is None:
             return res
-        if self.rand_buf is None or self.rand_buf.size() != res.size():
-            self.rand_buf = torch.FloatTensor(res.size())
-            if input.is_cuda:
-                self.rand_buf = self.rand_buf.cuda()
-        torch.randn(self.rand_buf.size(), out=self.rand_buf)
-#        print(m.size(), res.size())
-        return res + torch.mul(sigma, Variable(self.rand_buf))
+        # noise is not cached between calls, so the layer could be captured into CUDA graph
+        # and used with different batch sizes without reallocations
+        return res + torch.mul(sigma, torch.randn_like(res))
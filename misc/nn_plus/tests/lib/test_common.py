@@ -0,0 +1,186 @@
+import unittest
+import collections
+import numpy as np
+
+from lib import common
+
+
+Experience = collections.namedtuple('Experience', field_names=['state', 'action', 'reward', 'last_state'])
+
+FRAMES = 4
+SHAPE = (FRAMES, 6, 6)
+
+
+def make_frames(count):
+    return np.random.randint(0, 256, size=(count, ) + SHAPE[1:]).astype(np.uint8)
+
+
+def make_exp(frames, t, steps_count, done=False):
+    """
+    Experience with state started at frame t, reward holds t to find state back
+    """
+    last_state = None if done else frames[t+steps_count:t+steps_count+FRAMES]
+    return Experience(state=frames[t:t+FRAMES], action=t % 3, reward=float(t), last_state=last_state)
+
+
+class StatesBufferLayout(unittest.TestCase):
+    def test_batch_to_tensors(self):
+        frames = make_frames(100)
+        for steps_count in (1, 2, FRAMES, FRAMES + 2):
+            batch = [make_exp(frames, t, steps_count, done=t % 3 == 0) for t in range(10)]
+            states_buf = common.StatesBuffer(len(batch), SHAPE, steps_count=steps_count)
+            self.assertEqual(states_buf.host.size()[1], FRAMES + min(steps_count, FRAMES))
+            states_v, actions_v, rewards_v, done_mask, next_states_v = common.batch_to_tensors(batch, states_buf)
+            for idx, exp in enumerate(batch):
+                self.assertTrue(np.array_equal(states_v[idx].numpy(), exp.state))
+                self.assertEqual(actions_v[idx].item(), exp.action)
+                self.assertEqual(rewards_v[idx].item(), exp.reward)
+                self.assertEqual(done_mask[idx].item(), exp.last_state is None)
+                if exp.last_state is not None:
+                    self.assertTrue(np.array_equal(next_states_v[idx].numpy(), exp.last_state))
+
+    def test_wrong_steps_count(self):
+        frames = make_frames(100)
+        batch = [make_exp(frames, t, 2) for t in range(10)]
+        states_buf = common.StatesBuffer(len(batch), SHAPE, steps_count=1)
+        with self.assertRaises(AssertionError):
+            common.batch_to_tensors(batch, states_buf)
+
+    def test_multichannel_frames(self):
+        # RGB frames stacked along channels don't share single planes
+        frames = make_frames(100)
+        state = np.concatenate([frames[t:t+3] for t in range(FRAMES)])
+        last_state = np.concatenate([frames[t:t+3] for t in range(1, FRAMES+1)])
+        batch = [Experience(state=state, action=0, reward=0.0, last_state=last_state)]
+        states_buf = common.StatesBuffer(len(batch), state.shape, steps_count=1)
+        with self.assertRaises(AssertionError):
+            common.batch_to_tensors(batch, states_buf)
+
+
+class DeviceReplayBufferSample(unittest.TestCase):
+    def check_sample(self, buffer, frames, steps_count, min_t):
+        states_v, actions_v, rewards_v, done_mask, next_states_v = buffer.sample(64)
+        for idx in range(64):
+            t = int(rewards_v[idx].item())
+            self.assertGreaterEqual(t, min_t)
+            self.assertTrue(np.array_equal(states_v[idx].numpy(), frames[t:t+FRAMES]))
+            self.assertEqual(actions_v[idx].item(), t % 3)
+            self.assertEqual(done_mask[idx].item(), t % 5 == 0)
+            if not done_mask[idx].item():
+                next_state = frames[t+steps_count:t+steps_count+FRAMES]
+                self.assertTrue(np.array_equal(next_states_v[idx].numpy(), next_state))
+
+    def test_sample(self):
+        frames = make_frames(200)
+        for steps_count in (1, 3):
+            source = (make_exp(frames, t, steps_count, done=t % 5 == 0) for t in range(150))
+            buffer = common.DeviceReplayBuffer(source, 30, SHAPE, steps_count=steps_count,
+                                               update_size=10, device="cpu")
+            buffer.populate(9)
+            self.assertEqual(len(buffer), 0)
+            buffer.populate(16)
+            self.assertEqual(len(buffer), 20)
+            self.assertEqual(len(buffer.pending), 5)
+            self.check_sample(buffer, frames, steps_count, min_t=0)
+
+            # wrap around the ring: only the last 30 pushed entries are kept
+            buffer.populate(75)
+            self.assertEqual(len(buffer), 30)
+            self.assertEqual(buffer.pos, 100 % 30)
+            self.check_sample(buffer, frames, steps_count, min_t=70)
+
+    def test_memory_size(self):
+        for steps_count in (1, 3, FRAMES + 2):
+            buffer = common.DeviceReplayBuffer(iter([]), 30, SHAPE, steps_count=steps_count, device="cpu")
+            size = sum(t.numel() * t.element_size()
+                       for t in (buffer.entries, buffer.actions, buffer.rewards, buffer.dones))
+            self.assertEqual(common.DeviceReplayBuffer.memory_size(30, SHAPE, steps_count=steps_count), size)
+
+
+class FakeExperienceSource:
+    """
+    Yields count integers, finishes episode on every third of them, then raises error if given
+    """
+    def __init__(self, count, error=None):
+        self.count = count
+        self.error = error
+        self.total_rewards = []
+
+    def __iter__(self):
+        for idx in range(self.count):
+            if idx % 3 == 2:
+                self.total_rewards.append(float(idx))
+            yield idx
+        if self.error is not None:
+            raise self.error
+
+    def pop_total_rewards(self):
+        r = self.total_rewards
+        if r:
+            self.total_rewards = []
+        return r
+
+
+class ThreadedExperienceSourceIter(unittest.TestCase):
+    def test_exhaustion(self):
+        exp_source = common.ThreadedExperienceSource(FakeExperienceSource(10), queue_size=4)
+        self.assertEqual(list(exp_source), list(range(10)))
+        self.assertEqual(exp_source.pop_total_rewards(), [2.0, 5.0, 8.0])
+        self.assertEqual(exp_source.pop_total_rewards(), [])
+
+    def test_error(self):
+        exp_source = common.ThreadedExperienceSource(FakeExperienceSource(5, error=ValueError("env failed")),
+                                                     queue_size=2)
+        items = []
+        with self.assertRaises(ValueError):
+            for item in exp_source:
+                items.append(item)
+        self.assertEqual(items, list(range(5)))
+        self.assertEqual(exp_source.pop_total_rewards(), [2.0])
+
+
+class CountingEnv:
+    """
+    Observation is the step index, reward equals the action, episode is done after 5 steps
+    """
+    def reset(self):
+        self.t = 0
+        return self.t
+
+    def step(self, action):
+        self.t += 1
+        return self.t, float(action), self.t == 5, {}
+
+
+def agent(states, agent_states):
+    return [s + 1 for s in states], agent_states
+
+
+class ProcessExperienceSourceIter(unittest.TestCase):
+    def test_first_last(self):
+        gamma = 0.5
+        for steps_count in (1, 2, 3):
+            exp_source = common.ProcessExperienceSource(CountingEnv, 2, agent, gamma, steps_count=steps_count)
+            entries = []
+            for exp in exp_source:
+                entries.append(exp)
+                if len(entries) == 20:
+                    break
+            exp_source.close()
+
+            # both envs make steps in the lockstep, so every episode gives 5 entries from each of them
+            self.assertEqual(exp_source.pop_total_rewards(), [15.0] * 4)
+            for exp in entries:
+                t = exp.state
+                self.assertEqual(exp.action, t + 1)
+                n = min(steps_count, 5 - t)
+                self.assertAlmostEqual(exp.reward, sum(gamma ** k * (t + 1 + k) for k in range(n)))
+                if t + n == 5:
+                    self.assertIsNone(exp.last_state)
+                else:
+                    self.assertEqual(exp.last_state, t + n)
+            self.assertEqual(sorted(exp.state for exp in entries), sorted(list(range(5)) * 4))
+
+
+if __name__ == '__main__':
+    unittest.main()
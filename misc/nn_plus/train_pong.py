@@ -7,7 +7,6 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.autograd import Variable
 
 from tensorboardX import SummaryWriter
 
@@ -15,16 +14,17 @@ from lib import model, common
 
 
 class NoisyDQN(nn.Module):
-    def __init__(self, input_shape, n_actions):
+    def __init__(self, input_shape, n_actions, channels_last=False):
         super(NoisyDQN, self).__init__()
+        self.channels_last = channels_last
 
         self.conv = nn.Sequential(
             nn.Conv2d(input_shape[0], 32, kernel_size=8, stride=4),
-            nn.ReLU(),
+            nn.ReLU(inplace=True),
             nn.Conv2d(32, 64, kernel_size=4, stride=2),
-            nn.ReLU(),
+            nn.ReLU(inplace=True),
             nn.Conv2d(64, 64, kernel_size=3, stride=1),
-            nn.ReLU()
+            nn.ReLU(inplace=True)
         )
 
         conv_out_size = self._get_conv_out(input_shape)
@@ -40,42 +40,119 @@ class NoisyDQN(nn.Module):
             nn.ReLU(),
             nn.Linear(512, 1)
         )
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
 
     def _get_conv_out(self, shape):
-        o = self.conv(Variable(torch.zeros(1, *shape)))
+        with torch.no_grad():
+            o = self.conv(torch.zeros(1, *shape))
         return int(np.prod(o.size()))
 
     def forward(self, x):
+        if self.channels_last:
+            # convert uint8 input, otherwise conv will convert four times bigger float tensor on every call
+            x = x.contiguous(memory_format=torch.channels_last)
         fx = x.float() / 256
-        conv_out = self.conv(fx).view(fx.size()[0], -1)
+        conv_out = self.conv(fx).flatten(1)
         sigma = self.sigma_layers(conv_out)
         fc_out = self.fc(conv_out)
         out = self.noisy_out(fc_out, sigma=sigma)
         return out
 
 
+def make_env():
+    return ptan.common.wrappers.wrap_dqn(gym.make(common.HYPERPARAMS['breakout']['env_name']))
+
+
 if __name__ == "__main__":
     params = common.HYPERPARAMS['breakout']
     parser = argparse.ArgumentParser()
     parser.add_argument("--cuda", default=False, action="store_true", help="Enable cuda")
+    parser.add_argument("--gpu-buffer", default=False, action="store_true",
+                        help="Keep replay buffer in GPU memory, requires --cuda")
+    parser.add_argument("--amp", default=False, action="store_true",
+                        help="Train in mixed precision, requires --cuda")
+    parser.add_argument("--cuda-graph", default=False, action="store_true",
+                        help="Capture train step into CUDA graph, requires --cuda, not compatible with --amp")
+    parser.add_argument("--async-env", default=False, action="store_true",
+                        help="Play environment in background thread, not compatible with --cuda-graph")
+    parser.add_argument("--channels-last", default=False, action="store_true",
+                        help="Keep convolutions in channels-last (NHWC) memory format")
+    parser.add_argument("--envs", type=int, default=1,
+                        help="Count of environments to play, with more than one every env is stepped in "
+                             "its own process, default=1")
+    parser.add_argument("--compile", default=False, action="store_true",
+                        help="Compile nets used in train step, not compatible with --cuda-graph")
+    parser.add_argument("-n", "--steps", type=int, default=1, help="Count of steps to unroll Bellman, default=1")
+    parser.add_argument("--replay-size", type=int, default=params['replay_size'],
+                        help="Count of entries kept in replay buffer, default=%d" % params['replay_size'])
     args = parser.parse_args()
-
-    env = gym.make(params['env_name'])
-    env = ptan.common.wrappers.wrap_dqn(env)
+    if args.amp and not args.cuda:
+        parser.error("--amp requires --cuda")
+    if args.gpu_buffer and not args.cuda:
+        parser.error("--gpu-buffer requires --cuda")
+    if args.cuda_graph and not args.cuda:
+        parser.error("--cuda-graph requires --cuda")
+    if args.cuda_graph and args.amp:
+        parser.error("--cuda-graph could not be used with --amp")
+    if args.cuda_graph and args.async_env:
+        parser.error("--cuda-graph could not be used with --async-env")
+    if args.cuda_graph and args.compile:
+        parser.error("--cuda-graph could not be used with --compile")
+    if args.cuda:
+        # batch shapes are fixed, so the fastest conv algorithms could be picked once on the first calls
+        torch.backends.cudnn.benchmark = True
+
+    env = make_env()
+    if args.gpu_buffer:
+        need_bytes = common.DeviceReplayBuffer.memory_size(args.replay_size, env.observation_space.shape,
+                                                           steps_count=args.steps)
+        free_bytes, _ = torch.cuda.mem_get_info()
+        if need_bytes > free_bytes:
+            parser.error("--gpu-buffer needs %.1f GB of GPU memory for %d entries, but only %.1f GB is free, "
+                         "reduce --replay-size" % (need_bytes / 2**30, args.replay_size, free_bytes / 2**30))
 
     writer = SummaryWriter(comment="-" + params['run_name'] + "-noisy-plus-1")
-    net = NoisyDQN(env.observation_space.shape, env.action_space.n)
+    net = NoisyDQN(env.observation_space.shape, env.action_space.n, channels_last=args.channels_last)
     if args.cuda:
         net.cuda()
 
     tgt_net = ptan.agent.TargetNet(net)
-    agent = ptan.agent.DQNAgent(net, ptan.actions.ArgmaxActionSelector(), cuda=args.cuda)
-
-    exp_source = ptan.experience.ExperienceSourceFirstLast(env, agent, gamma=params['gamma'], steps_count=1)
-    buffer = ptan.experience.ExperienceReplayBuffer(exp_source, buffer_size=params['replay_size'])
-    optimizer = optim.Adam(net.parameters(), lr=params['learning_rate'])
+    agent = ptan.agent.DQNAgent(net, ptan.actions.ArgmaxActionSelector(), cuda=args.cuda,
+                                preprocessor=common.states_preprocessor)
+
+    if args.envs > 1:
+        exp_source = common.ProcessExperienceSource(make_env, args.envs, agent, gamma=params['gamma'],
+                                                    steps_count=args.steps)
+    else:
+        exp_source = ptan.experience.ExperienceSourceFirstLast(env, agent, gamma=params['gamma'],
+                                                               steps_count=args.steps)
+    # rewards are discounted over the steps by experience source, last state's value has to be discounted by gamma^n
+    last_gamma = params['gamma'] ** args.steps
+    if args.async_env:
+        exp_source = common.ThreadedExperienceSource(exp_source)
+    if args.gpu_buffer:
+        buffer = common.DeviceReplayBuffer(exp_source, args.replay_size, env.observation_space.shape,
+                                           steps_count=args.steps)
+    else:
+        buffer = ptan.experience.ExperienceReplayBuffer(exp_source, buffer_size=args.replay_size)
+    optimizer = optim.Adam(net.parameters(), lr=params['learning_rate'],
+                           capturable=args.cuda_graph, fused=args.cuda)
+    states_buf = common.StatesBuffer(params['batch_size'], env.observation_space.shape,
+                                     steps_count=args.steps, cuda=args.cuda)
+    scaler = torch.amp.GradScaler("cuda", enabled=args.amp)
+    # ptan's agent and target net sync work with plain modules, compiled wrappers share their parameters
+    train_net, train_tgt_net = net, tgt_net.target_model
+    if args.compile:
+        train_net = torch.compile(net, mode="reduce-overhead", dynamic=False)
+        train_tgt_net = torch.compile(tgt_net.target_model, mode="reduce-overhead", dynamic=False)
+    train_step = None
+    if args.cuda_graph:
+        train_step = common.GraphedTrainStep(net, tgt_net.target_model, optimizer, last_gamma,
+                                             params['batch_size'], env.observation_space.shape)
 
     frame_idx = 0
+    sync_frame_idx = 0
 
     with common.RewardTracker(writer, params['stop_reward']) as reward_tracker:
         while True:
@@ -83,18 +160,25 @@ if __name__ == "__main__":
             buffer.populate(1)
 
             new_rewards = exp_source.pop_total_rewards()
-            if new_rewards:
-                if reward_tracker.reward(new_rewards[0], frame_idx):
-                    break
+            if new_rewards and any(reward_tracker.reward(reward, frame_idx) for reward in new_rewards):
+                break
 
             if len(buffer) < params['replay_initial']:
                 continue
 
-            optimizer.zero_grad()
             batch = buffer.sample(params['batch_size'])
-            loss_v = common.calc_loss_dqn(batch, net, tgt_net.target_model, gamma=params['gamma'], cuda=args.cuda)
-            loss_v.backward()
-            optimizer.step()
-
-            if frame_idx % params['target_net_sync'] == 0:
+            if not args.gpu_buffer:
+                batch = common.batch_to_tensors(batch, states_buf, cuda=args.cuda)
+            if train_step is not None:
+                train_step.step(*batch)
+            else:
+                optimizer.zero_grad(set_to_none=True)
+                with torch.autocast("cuda", enabled=args.amp):
+                    loss_v = common.calc_loss_dqn_v(*batch, train_net, train_tgt_net, gamma=last_gamma)
+                scaler.scale(loss_v).backward()
+                scaler.step(optimizer)
+                scaler.update()
+
+            if frame_idx - sync_frame_idx >= params['target_net_sync']:
                 tgt_net.sync()
+                sync_frame_idx = frame_idx